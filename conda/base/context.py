@@ -155,6 +155,8 @@ class Context(Configuration):
     disallowed_packages = SequenceParameter(string_types, aliases=('disallow',),
                                             string_delimiter='&')
     rollback_enabled = PrimitiveParameter(True)
+    execute_threads = PrimitiveParameter(0)
+    parallel_pre_link_scripts = PrimitiveParameter(True)
     track_features = SequenceParameter(string_types)
     use_index_cache = PrimitiveParameter(False)
 
@@ -781,6 +783,8 @@ class Context(Configuration):
             'always_softlink',
             'path_conflict',
             'rollback_enabled',
+            'execute_threads',
+            'parallel_pre_link_scripts',
             'safety_checks',
             'extra_safety_checks',
             'shortcuts',
@@ -998,6 +1002,12 @@ class Context(Configuration):
                 flag), or otherwise holds the value of '{prefix}'. Templating uses python's
                 str.format() method.
                 """),
+            'execute_threads': dals("""
+                Number of threads used to unlink and link packages while executing a
+                transaction. Set to 1 to execute package actions serially, e.g. on filesystems
+                that misbehave under concurrent access. The default of 0 uses conda's shared
+                thread pool.
+                """),
             'force_reinstall': dals("""
                 Ensure that any user-requested package for the current operation is uninstalled
                 and reinstalled, even if that package already exists in the environment.
@@ -1047,6 +1057,11 @@ class Context(Configuration):
             'override_channels_enabled': dals("""
                 Permit use of the --overide-channels command-line flag.
                 """),
+            'parallel_pre_link_scripts': dals("""
+                Run the pre-link scripts of the packages in a transaction concurrently. Set to
+                False if those scripts depend on running one at a time. Pre-unlink scripts
+                always run one at a time.
+                """),
             'path_conflict': dals("""
                 The method by which conda handle's conflicting/overlapping paths during a
                 create, install, or update operation. The value must be one of 'clobber',
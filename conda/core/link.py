@@ -4,9 +4,13 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from collections import defaultdict, namedtuple
+from errno import ENOENT
+from itertools import chain
 from logging import getLogger
 import os
+from os import listdir
 from os.path import basename, dirname, isdir, join
+import re
 import sys
 from traceback import format_exception_only
 import warnings
@@ -19,12 +23,11 @@ from .path_actions import (CompileMultiPycAction, CreateNonadminAction, CreatePr
                            UpdateHistoryAction, AggregateCompileMultiPycAction)
 from .prefix_data import PrefixData, get_python_version_for_prefix
 from .. import CondaError, CondaMultiError, conda_signal_handler
-from .._vendor.auxlib.collection import first
 from .._vendor.auxlib.ish import dals
-from .._vendor.toolz import concat, concatv, interleave
+from .._vendor.toolz import interleave
 from ..base.constants import DEFAULTS_CHANNEL_NAME, PREFIX_MAGIC_FILE, SafetyChecks
 from ..base.context import context
-from ..common.compat import ensure_text_type, iteritems, itervalues, odict, on_win, text_type
+from ..common.compat import PY3, ensure_text_type, odict, on_win, range, text_type
 from ..common.io import Spinner, dashlist, time_recorder
 from ..common.io import DummyExecutor, ThreadLimitedThreadPoolExecutor, as_completed
 from ..common.path import (explode_directories, get_all_directories, get_major_minor_version,
@@ -46,21 +49,65 @@ from ..utils import ensure_comspec_set, human_bytes, wrap_subprocess_call
 log = getLogger(__name__)
 
 
+if on_win:
+    def _lower_on_win(path):
+        # paths within a prefix compare case-insensitively on windows
+        return path.lower()
+else:
+    def _lower_on_win(path):
+        return path
+
+
+def _has_case_sensitive_names(path):
+    # look the directory up again with the case of its own name flipped; on a case-insensitive
+    #   filesystem that finds the same directory
+    path = path.rstrip('/\\')
+    flipped_name = basename(path).swapcase()
+    if flipped_name == basename(path):
+        # nothing to flip; assume the worst
+        return False
+    return not lexists(join(dirname(path), flipped_name))
+
+
+# number of actions verified per executor task in _verify_individual_level
+_VERIFY_SLICE_SIZE = 256
+
+
+def _verify_actions(actions):
+    return tuple(axn.verify() for axn in actions)
+
+
+_LINK_SUPPORT_CACHE = {}
+
+
+def _link_supported(link_test, extracted_package_dir, target_prefix):
+    # Link support is a property of the filesystems involved, not of any one package, so probe
+    #   once per package cache directory and target prefix rather than once per package.
+    cache_key = (link_test, dirname(extracted_package_dir), target_prefix)
+    supported = _LINK_SUPPORT_CACHE.get(cache_key)
+    if supported is None:
+        source_test_file = join(extracted_package_dir, 'info', 'index.json')
+        supported = _LINK_SUPPORT_CACHE[cache_key] = link_test(source_test_file, target_prefix)
+    return supported
+
+
 def determine_link_type(extracted_package_dir, target_prefix):
-    source_test_file = join(extracted_package_dir, 'info', 'index.json')
     if context.always_copy:
         return LinkType.copy
     if context.always_softlink:
         return LinkType.softlink
-    if hardlink_supported(source_test_file, target_prefix):
+    if _link_supported(hardlink_supported, extracted_package_dir, target_prefix):
         return LinkType.hardlink
-    if context.allow_softlinks and softlink_supported(source_test_file, target_prefix):
+    if context.allow_softlinks and _link_supported(softlink_supported, extracted_package_dir,
+                                                   target_prefix):
         return LinkType.softlink
     return LinkType.copy
 
 
-def make_unlink_actions(transaction_context, target_prefix, prefix_record):
+def make_unlink_actions(transaction_context, target_prefix, prefix_record, all_directories=None):
     # no side effects in this function!
+    # all_directories, if given, is the deepest-first sequence of directories to remove along
+    #   with this package; by default it's derived from the package's own files
     unlink_path_actions = tuple(UnlinkPathAction(transaction_context, prefix_record,
                                                  target_prefix, trgt)
                                 for trgt in prefix_record.files)
@@ -84,8 +131,9 @@ def make_unlink_actions(transaction_context, target_prefix, prefix_record):
                                                                  prefix_record,
                                                                  target_prefix, meta_short_path),)
 
-    _all_d = get_all_directories(axn.target_short_path for axn in unlink_path_actions)
-    all_directories = sorted(explode_directories(_all_d, already_split=True), reverse=True)
+    if all_directories is None:
+        _all_d = get_all_directories(axn.target_short_path for axn in unlink_path_actions)
+        all_directories = sorted(explode_directories(_all_d, already_split=True), reverse=True)
     directory_remove_actions = tuple(UnlinkPathAction(transaction_context, prefix_record,
                                                       target_prefix, d, LinkType.directory)
                                      for d in all_directories)
@@ -94,7 +142,7 @@ def make_unlink_actions(transaction_context, target_prefix, prefix_record):
     #     transaction_context, package_cache_record, target_prefix
     # )
 
-    return tuple(concatv(
+    return tuple(chain(
         remove_menu_actions,
         unlink_path_actions,
         directory_remove_actions,
@@ -104,12 +152,13 @@ def make_unlink_actions(transaction_context, target_prefix, prefix_record):
 
 
 def match_specs_to_dists(packages_info_to_link, specs):
-    matched_specs = [None for _ in range(len(packages_info_to_link))]
+    name_to_idx = {}
+    for q, pkg_info in enumerate(packages_info_to_link):
+        name_to_idx.setdefault(pkg_info.repodata_record.name, q)
+    matched_specs = [None] * len(packages_info_to_link)
     for spec in specs or ():
         spec = MatchSpec(spec)
-        idx = next((q for q, pkg_info in enumerate(packages_info_to_link)
-                    if pkg_info.repodata_record.name == spec.name),
-                   None)
+        idx = name_to_idx.get(spec.name)
         if idx is not None:
             matched_specs[idx] = spec
     return tuple(matched_specs)
@@ -157,10 +206,11 @@ ChangeReport = namedtuple("ChangeReport", (
 class UnlinkLinkTransaction(object):
 
     def __init__(self, *setups):
+        # prefix ordering is significant, and plain dicts don't keep it before python 3.7
         self.prefix_setups = odict((stp.target_prefix, stp) for stp in setups)
         self.prefix_action_groups = odict()
 
-        for stp in itervalues(self.prefix_setups):
+        for stp in self.prefix_setups.values():
             log.info("initializing UnlinkLinkTransaction with\n"
                      "  target_prefix: %s\n"
                      "  unlink_precs:\n"
@@ -172,17 +222,26 @@ class UnlinkLinkTransaction(object):
                      '\n    '.join(prec.dist_str() for prec in stp.link_precs))
 
         self._pfe = None
+        self._download_urls = None
         self._prepared = False
         self._verified = False
+        self._prefix_records_cache = {}
         self.executor = DummyExecutor() if context.debug else ThreadLimitedThreadPoolExecutor()
+        if context.debug or context.execute_threads == 1:
+            self.execute_executor = DummyExecutor()
+        elif context.execute_threads:
+            self.execute_executor = ThreadLimitedThreadPoolExecutor(context.execute_threads)
+        else:
+            self.execute_executor = self.executor
 
     @property
     def nothing_to_do(self):
-        return (
-            not any((stp.unlink_precs or stp.link_precs) for stp in itervalues(self.prefix_setups))
-            and all(is_conda_environment(stp.target_prefix)
-                    for stp in itervalues(self.prefix_setups))
-        )
+        prefix_setups = self.prefix_setups.values()
+        # check for pending work before touching the disk; the is_conda_environment probes
+        #   are only needed when there are no records to unlink or link
+        if any(stp.unlink_precs or stp.link_precs for stp in prefix_setups):
+            return False
+        return all(is_conda_environment(stp.target_prefix) for stp in prefix_setups)
 
     def download_and_extract(self):
         if self._pfe is None:
@@ -203,7 +262,7 @@ class UnlinkLinkTransaction(object):
 
         with Spinner("Preparing transaction", not context.verbosity and not context.quiet,
                      context.json):
-            for stp in itervalues(self.prefix_setups):
+            for stp in self.prefix_setups.values():
                 grps = self._prepare(self.transaction_context, stp.target_prefix,
                                      stp.unlink_precs, stp.link_precs,
                                      stp.remove_specs, stp.update_specs)
@@ -242,10 +301,18 @@ class UnlinkLinkTransaction(object):
         assert not context.dry_run
 
         try:
-            self._execute(tuple(concat(interleave(itervalues(self.prefix_action_groups)))))
+            self._execute(chain.from_iterable(interleave(self.prefix_action_groups.values())))
         finally:
             rm_rf(self.transaction_context['temp_dir'])
 
+    def _get_prefix_records(self, target_prefix):
+        # snapshot of the records in a prefix, shared by all of the verification passes
+        prefix_recs = self._prefix_records_cache.get(target_prefix)
+        if prefix_recs is None:
+            prefix_recs = tuple(PrefixData(target_prefix).iter_records())
+            self._prefix_records_cache[target_prefix] = prefix_recs
+        return prefix_recs
+
     def _get_pfe(self):
         from .package_cache_data import ProgressiveFetchExtract
         if self._pfe is not None:
@@ -253,12 +320,19 @@ class UnlinkLinkTransaction(object):
         elif not self.prefix_setups:
             self._pfe = pfe = ProgressiveFetchExtract(())
         else:
-            link_precs = set(concat(stp.link_precs for stp in itervalues(self.prefix_setups)))
+            link_precs = set(chain.from_iterable(stp.link_precs
+                                                 for stp in self.prefix_setups.values()))
             self._pfe = pfe = ProgressiveFetchExtract(link_precs)
         return pfe
 
-    @classmethod
-    def _prepare(cls, transaction_context, target_prefix, unlink_precs, link_precs,
+    def _get_download_urls(self):
+        if self._download_urls is None:
+            pfe = self._get_pfe()
+            pfe.prepare()
+            self._download_urls = frozenset(axn.url for axn in pfe.cache_actions)
+        return self._download_urls
+
+    def _prepare(self, transaction_context, target_prefix, unlink_precs, link_precs,
                  remove_specs, update_specs):
 
         # make sure prefix directory exists
@@ -280,29 +354,39 @@ class UnlinkLinkTransaction(object):
         pkg_cache_recs_to_link = tuple(PackageCacheData.get_entry_to_link(prec)
                                        for prec in link_precs)
         assert all(pkg_cache_recs_to_link)
-        packages_info_to_link = tuple(read_package_info(prec, pcrec)
-                                      for prec, pcrec in zip(link_precs, pkg_cache_recs_to_link))
+        # reading package metadata is disk-bound, so overlap the reads across packages
+        packages_info_to_link = tuple(self.executor.map(read_package_info, link_precs,
+                                                        pkg_cache_recs_to_link))
 
         link_types = tuple(determine_link_type(pkg_info.extracted_package_dir, target_prefix)
                            for pkg_info in packages_info_to_link)
 
         # make all the path actions
         # no side effects allowed when instantiating these action objects
-        python_version = cls._get_python_version(target_prefix,
-                                                 prefix_recs_to_unlink,
-                                                 packages_info_to_link)
+        python_version = self._get_python_version(target_prefix,
+                                                  prefix_recs_to_unlink,
+                                                  packages_info_to_link)
         transaction_context['target_python_version'] = python_version
         sp = get_python_site_packages_short_path(python_version)
         transaction_context['target_site_packages_short_path'] = sp
 
         transaction_context['temp_dir'] = join(target_prefix, '.condatmp')
 
+        # Directories to remove are computed once across every package being unlinked, rather
+        #   than per package, and attached to the last unlink group. Parents shared between
+        #   packages (e.g. lib/) then get a single removal attempt, which happens during cleanup
+        #   after the files of all unlinked packages are gone.
+        _all_d = get_all_directories(chain.from_iterable(prefix_rec.files
+                                                         for prefix_rec in prefix_recs_to_unlink))
+        unlink_directories = sorted(explode_directories(_all_d, already_split=True), reverse=True)
+        last_unlink_idx = len(prefix_recs_to_unlink) - 1
         unlink_action_groups = tuple(ActionGroup(
             'unlink',
             prefix_rec,
-            make_unlink_actions(transaction_context, target_prefix, prefix_rec),
+            make_unlink_actions(transaction_context, target_prefix, prefix_rec,
+                                unlink_directories if q == last_unlink_idx else ()),
             target_prefix,
-        ) for prefix_rec in prefix_recs_to_unlink)
+        ) for q, prefix_rec in enumerate(prefix_recs_to_unlink))
 
         if unlink_action_groups:
             axns = UnregisterEnvironmentLocationAction(transaction_context, target_prefix),
@@ -311,40 +395,26 @@ class UnlinkLinkTransaction(object):
             unregister_action_groups = ()
 
         matchspecs_for_link_dists = match_specs_to_dists(packages_info_to_link, update_specs)
-        link_action_groups = tuple(
-            ActionGroup('link', pkg_info, cls._make_link_actions(transaction_context, pkg_info,
-                                                                 target_prefix, lt, spec),
-                        target_prefix)
-            for pkg_info, lt, spec in zip(packages_info_to_link, link_types,
-                                          matchspecs_for_link_dists)
-        )
-
-        entry_point_action_groups = tuple(
-            ActionGroup('entry_point', pkg_info, cls._make_entry_point_actions(
-                transaction_context, pkg_info, target_prefix, lt, spec, link_action_groups),
-                        target_prefix)
-            for pkg_info, lt, spec in zip(packages_info_to_link, link_types,
-                                          matchspecs_for_link_dists)
-        )
-
-        compile_action_groups = tuple(
-            ActionGroup('compile', pkg_info, cls._make_compile_actions(
-                transaction_context, pkg_info, target_prefix, lt, spec, link_action_groups),
-                        target_prefix)
-            for pkg_info, lt, spec in zip(packages_info_to_link, link_types,
-                                          matchspecs_for_link_dists)
-        )
-
+        # build every per-package group in a single pass over the packages being linked
+        link_action_groups = []
+        entry_point_action_groups = []
+        compile_action_groups = []
         record_axns = []
         for pkg_info, lt, spec in zip(packages_info_to_link, link_types,
                                       matchspecs_for_link_dists):
-            link_ag = next(ag for ag in link_action_groups if ag.pkg_data == pkg_info)
-            compile_ag = next(ag for ag in compile_action_groups if ag.pkg_data == pkg_info)
-            entry_point_ag = next(ag for ag in entry_point_action_groups
-                                  if ag.pkg_data == pkg_info)
-            all_link_path_actions = concatv(link_ag.actions,
-                                            compile_ag.actions,
-                                            entry_point_ag.actions)
+            link_ag = ActionGroup('link', pkg_info, self._make_link_actions(
+                transaction_context, pkg_info, target_prefix, lt, spec), target_prefix)
+            entry_point_ag = ActionGroup('entry_point', pkg_info, self._make_entry_point_actions(
+                transaction_context, pkg_info, target_prefix, lt, spec, link_ag), target_prefix)
+            compile_ag = ActionGroup('compile', pkg_info, self._make_compile_actions(
+                transaction_context, pkg_info, target_prefix, lt, spec, link_ag), target_prefix)
+            link_action_groups.append(link_ag)
+            entry_point_action_groups.append(entry_point_ag)
+            compile_action_groups.append(compile_ag)
+
+            all_link_path_actions = chain(link_ag.actions,
+                                          compile_ag.actions,
+                                          entry_point_ag.actions)
             record_axns.extend(CreatePrefixRecordAction.create_actions(
                 transaction_context, pkg_info, target_prefix, lt, spec, all_link_path_actions))
         prefix_record_groups = [ActionGroup('record', None, record_axns, target_prefix)]
@@ -360,35 +430,46 @@ class UnlinkLinkTransaction(object):
         return PrefixActionGroup(
             unlink_action_groups,
             unregister_action_groups,
-            link_action_groups,
+            tuple(link_action_groups),
             register_action_groups,
-            compile_action_groups,
-            entry_point_action_groups,
+            tuple(compile_action_groups),
+            tuple(entry_point_action_groups),
             prefix_record_groups,
         )
 
-    @staticmethod
-    def _verify_individual_level(prefix_action_group):
-        all_actions = concat(axngroup.actions
-                             for action_groups in prefix_action_group
-                             for axngroup in action_groups)
+    def _verify_individual_level(self, prefix_action_groups):
+        # actions from every prefix are pooled before being sliced, so a transaction's slices
+        #   stay full no matter how its actions are spread across prefixes
+        unverified_actions = tuple(axn
+                                   for prefix_action_group in prefix_action_groups
+                                   for action_groups in prefix_action_group
+                                   for axngroup in action_groups
+                                   for axn in axngroup.actions
+                                   if not axn.verified)
 
         # run all per-action verify methods
         #   one of the more important of these checks is to verify that a file listed in
         #   the packages manifest (i.e. info/files) is actually contained within the package
+        # these are mostly disk-bound (existence checks, sizes, checksums, prefix replacement),
+        #   so they're spread across the executor; most are a single cheap stat though, so they
+        #   go out in slices to keep the per-task overhead from outweighing the work
         error_results = []
-        for axn in all_actions:
-            if axn.verified:
-                continue
-            error_result = axn.verify()
+        action_slices = tuple(unverified_actions[q:q + _VERIFY_SLICE_SIZE]
+                              for q in range(0, len(unverified_actions), _VERIFY_SLICE_SIZE))
+        if len(action_slices) > 1:
+            verify_results = chain.from_iterable(self.executor.map(_verify_actions,
+                                                                   action_slices))
+        else:
+            # nothing to spread; skip the executor round trip
+            verify_results = chain.from_iterable(map(_verify_actions, action_slices))
+        for axn, error_result in zip(unverified_actions, verify_results):
             if error_result:
                 formatted_error = ''.join(format_exception_only(type(error_result), error_result))
                 log.debug("Verification error in action %s\n%s", axn, formatted_error)
                 error_results.append(error_result)
         return error_results
 
-    @staticmethod
-    def _verify_prefix_level(target_prefix, prefix_action_group):
+    def _verify_prefix_level(self, target_prefix, prefix_action_group):
         # further verification of the whole transaction
         # for each path we are creating in link_actions, we need to make sure
         #   1. each path either doesn't already exist in the prefix, or will be unlinked
@@ -401,8 +482,7 @@ class UnlinkLinkTransaction(object):
         unlink_action_groups = prefix_action_group.unlink_action_groups
         prefix_record_groups = prefix_action_group.prefix_record_groups
 
-        lower_on_win = lambda p: p.lower() if on_win else p
-        unlink_paths = set(lower_on_win(axn.target_short_path)
+        unlink_paths = set(_lower_on_win(axn.target_short_path)
                            for grp in unlink_action_groups
                            for axn in grp.actions
                            if isinstance(axn, UnlinkPathAction))
@@ -413,30 +493,61 @@ class UnlinkLinkTransaction(object):
                               for axn in grp.actions
                               if isinstance(axn, CreatePrefixRecordAction))
 
+        # snapshot the contents of each parent directory once, instead of an lstat per path
+        dir_entries = {}
+        # the snapshots match names exactly (lowercased on windows); on other case-insensitive
+        #   filesystems, like macOS's default, a miss may still be a differently-cased file, so
+        #   misses there are confirmed with lexists
+        confirm_misses = not on_win and not _has_case_sensitive_names(target_prefix)
+
+        def path_exists(short_path):
+            parent, _, name = short_path.rpartition('/')
+            entries = dir_entries.get(parent)
+            if entries is None:
+                try:
+                    entries = set(map(_lower_on_win, listdir(join(target_prefix, parent))))
+                except EnvironmentError:
+                    # no parent directory, so no path either
+                    entries = set()
+                dir_entries[parent] = entries
+            if name in entries:
+                return True
+            # an empty snapshot means there's nothing in the directory under any case
+            return bool(entries and confirm_misses and lexists(join(target_prefix, short_path)))
+
+        # index prefix records by the paths they own, for attributing collisions; collisions
+        #   are rare, so the index is only built once the first one is found
+        path_to_prefix_rec = {}
+
+        def colliding_prefix_rec_for(path):
+            if not path_to_prefix_rec:
+                for prefix_rec in self._get_prefix_records(target_prefix):
+                    for prefix_path in prefix_rec.files:
+                        path_to_prefix_rec.setdefault(_lower_on_win(prefix_path), prefix_rec)
+            return path_to_prefix_rec.get(path)
+
         error_results = []
         # Verification 1. each path either doesn't already exist in the prefix, or will be unlinked
         link_paths_dict = defaultdict(list)
+        # this loop runs once per file being linked; keep the lookups it repeats in locals
+        lower_on_win = _lower_on_win
+        directory_link_type = LinkType.directory
         for axn in create_lpr_actions:
             for link_path_action in axn.all_link_path_actions:
                 if isinstance(link_path_action, CompileMultiPycAction):
                     target_short_paths = link_path_action.target_short_paths
                 elif isinstance(link_path_action, CreateNonadminAction):
                     continue
+                elif getattr(link_path_action, 'link_type', None) == directory_link_type:
+                    continue
                 else:
-                    target_short_paths = ((link_path_action.target_short_path, )
-                                          if not hasattr(link_path_action, 'link_type') or
-                                          link_path_action.link_type != LinkType.directory
-                                          else tuple())
+                    target_short_paths = (link_path_action.target_short_path, )
                 for path in target_short_paths:
                     path = lower_on_win(path)
                     link_paths_dict[path].append(axn)
-                    if path not in unlink_paths and lexists(join(target_prefix, path)):
+                    if path not in unlink_paths and path_exists(path):
                         # we have a collision; at least try to figure out where it came from
-                        colliding_prefix_rec = first(
-                            (prefix_rec for prefix_rec in
-                             PrefixData(target_prefix).iter_records()),
-                            key=lambda prefix_rec: path in prefix_rec.files
-                        )
+                        colliding_prefix_rec = colliding_prefix_rec_for(path)
                         if colliding_prefix_rec:
                             error_results.append(KnownPackageClobberError(
                                 path,
@@ -452,7 +563,7 @@ class UnlinkLinkTransaction(object):
                             ))
 
         # Verification 2. there's only a single instance of each path
-        for path, axns in iteritems(link_paths_dict):
+        for path, axns in link_paths_dict.items():
             if len(axns) > 1:
                 error_results.append(SharedLinkPathClobberError(
                     path,
@@ -461,8 +572,7 @@ class UnlinkLinkTransaction(object):
                 ))
         return error_results
 
-    @staticmethod
-    def _verify_transaction_level(prefix_setups):
+    def _verify_transaction_level(self, prefix_setups):
         # 1. make sure we're not removing conda from conda's env
         # 2. make sure we're not removing a conda dependency from conda's env
         # 3. enforce context.disallowed_packages
@@ -471,7 +581,7 @@ class UnlinkLinkTransaction(object):
         # TODO: Verification 4
 
         conda_prefixes = (join(context.root_prefix, 'envs', '_conda_'), context.root_prefix)
-        conda_setups = tuple(setup for setup in itervalues(prefix_setups)
+        conda_setups = tuple(setup for setup in prefix_setups.values()
                              if setup.target_prefix in conda_prefixes)
 
         conda_unlinked = any(prec.name == 'conda'
@@ -495,18 +605,18 @@ class UnlinkLinkTransaction(object):
         if conda_final_setup is None:
             # means we're not unlinking then linking a new package, so look up current conda record
             conda_final_prefix = context.conda_prefix
-            pd = PrefixData(conda_final_prefix)
-            pkg_names_already_lnkd = tuple(rec.name for rec in pd.iter_records())
+            prefix_recs = self._get_prefix_records(conda_final_prefix)
+            pkg_names_already_lnkd = tuple(rec.name for rec in prefix_recs)
             pkg_names_being_lnkd = ()
             pkg_names_being_unlnkd = ()
             conda_linked_depends = next(
-                (record.depends for record in pd.iter_records() if record.name == 'conda'),
+                (record.depends for record in prefix_recs if record.name == 'conda'),
                 ()
             )
         else:
             conda_final_prefix = conda_final_setup.target_prefix
-            pd = PrefixData(conda_final_prefix)
-            pkg_names_already_lnkd = tuple(rec.name for rec in pd.iter_records())
+            prefix_recs = self._get_prefix_records(conda_final_prefix)
+            pkg_names_already_lnkd = tuple(rec.name for rec in prefix_recs)
             pkg_names_being_lnkd = tuple(prec.name for prec in conda_final_setup.link_precs or ())
             pkg_names_being_unlnkd = tuple(prec.name for prec in conda_final_setup.unlink_precs
                                            or ())
@@ -523,18 +633,19 @@ class UnlinkLinkTransaction(object):
 
         # Verification 3. enforce disallowed_packages
         disallowed = tuple(MatchSpec(s) for s in context.disallowed_packages)
-        for prefix_setup in itervalues(prefix_setups):
+        for prefix_setup in prefix_setups.values():
             for prec in prefix_setup.link_precs:
                 if any(d.match(prec) for d in disallowed):
                     yield DisallowedPackageError(prec)
 
         # Verification 5. make sure conda-meta/history for each prefix is writable
-        for prefix_setup in itervalues(prefix_setups):
+        for prefix_setup in prefix_setups.values():
             test_path = join(prefix_setup.target_prefix, PREFIX_MAGIC_FILE)
             test_path_existed = lexists(test_path)
             dir_existed = None
             try:
-                dir_existed = mkdir_p(dirname(test_path))
+                # an existing history file means conda-meta is already there
+                dir_existed = test_path_existed or mkdir_p(dirname(test_path))
                 open(test_path, "a").close()
             except EnvironmentError:
                 if dir_existed is False:
@@ -548,31 +659,53 @@ class UnlinkLinkTransaction(object):
 
     def _verify(self, prefix_setups, prefix_action_groups):
         transaction_exceptions = tuple(
-            exc for exc in UnlinkLinkTransaction._verify_transaction_level(prefix_setups) if exc
+            exc for exc in self._verify_transaction_level(prefix_setups) if exc
         )
         if transaction_exceptions:
             return transaction_exceptions
 
         exceptions = []
-        futures = list(self.executor.submit(UnlinkLinkTransaction._verify_individual_level, pg)
-                       for pg in itervalues(prefix_action_groups))
-        futures.extend(
-            self.executor.submit(UnlinkLinkTransaction._verify_prefix_level, target_prefix, pg)
-            for target_prefix, pg in iteritems(prefix_action_groups))
+        futures = list(self.executor.submit(self._verify_prefix_level, target_prefix, pg)
+                       for target_prefix, pg in prefix_action_groups.items())
+        # individual-level verification fans out over the executor itself, so it's driven from
+        #   this thread rather than tying up a worker waiting on its own sub-tasks
+        exceptions.extend(self._verify_individual_level(prefix_action_groups.values()))
         for future in as_completed(futures):
             if future.result():
                 exceptions.extend(future.result())
         return exceptions
 
     def _execute(self, all_action_groups):
+        # all_action_groups can be a one-shot iterator; partition it by type in a single pass,
+        #   keeping the overall ordering for rollback and cleanup
+        groups_by_type = defaultdict(list)
+        ordered_action_groups = []
+        for group in all_action_groups:
+            groups_by_type[group.type].append(group)
+            ordered_action_groups.append(group)
+        all_action_groups = ordered_action_groups
         # unlink unlink_action_groups and unregister_action_groups
-        unlink_actions = tuple(group for group in all_action_groups if group.type == "unlink")
+        unlink_actions = groups_by_type["unlink"]
         # link unlink_action_groups and register_action_groups
-        link_actions = list(group for group in all_action_groups if group.type == "link")
-        compile_actions = list(group for group in all_action_groups if group.type == "compile")
-        entry_point_actions = list(group for group in all_action_groups
-                                   if group.type == "entry_point")
-        record_actions = list(group for group in all_action_groups if group.type == "record")
+        link_actions = groups_by_type["link"]
+        compile_actions = groups_by_type["compile"]
+        entry_point_actions = groups_by_type["entry_point"]
+        record_actions = groups_by_type["record"]
+        executor = self.execute_executor
+
+        # every package group writes under conda-meta; check for it once per prefix here
+        #   instead of in each group
+        for target_prefix in set(axngroup.target_prefix for axngroup in all_action_groups):
+            conda_meta_dir = join(target_prefix, 'conda-meta')
+            if not isdir(conda_meta_dir):
+                mkdir_p(conda_meta_dir)
+
+        # a plain dict snapshot of the environment for package scripts; copying it per script is
+        #   cheaper than copying os.environ, which re-encodes every entry
+        if on_win:
+            # run_script may correct COMSPEC; do it before the snapshot so scripts inherit it
+            ensure_comspec_set()
+        base_env = os.environ.copy()
 
         with signal_handler(conda_signal_handler), time_recorder("unlink_link_execute"):
             exceptions = []
@@ -584,18 +717,14 @@ class UnlinkLinkTransaction(object):
                         (unlink_actions, "unregister", False),
                         (link_actions, "register", True)):
 
-                    for axngroup in group:
-                        is_unlink = axngroup.type == 'unlink'
-                        target_prefix = axngroup.target_prefix
-                        prec = axngroup.pkg_data
-                        run_script(target_prefix if is_unlink else prec.extracted_package_dir,
-                                   prec,
-                                   'pre-unlink' if is_unlink else 'pre-link',
-                                   target_prefix)
+                    self._run_pre_scripts(group, install_side, base_env)
+
+                    if install_side:
+                        UnlinkLinkTransaction._create_link_directories(group)
 
                     # parallel block 1:
                     futures = (
-                        self.executor.submit(UnlinkLinkTransaction._execute_actions, axngroup)
+                        executor.submit(UnlinkLinkTransaction._execute_actions, axngroup)
                         for axngroup in group)
                     for future in as_completed(futures):
                         exc = future.result()
@@ -603,18 +732,14 @@ class UnlinkLinkTransaction(object):
                             exceptions.append(exc)
 
                     # Run post-link or post-unlink scripts and registering AFTER link/unlink,
-                    #    because they may depend on files in the prefix.  Additionally, run
-                    #    them serially, just in case order matters (hopefully not)
-                    for axngroup in group:
-                        exc = UnlinkLinkTransaction._execute_post_link_actions(axngroup)
-                        if exc:
-                            exceptions.append(exc)
+                    #    because they may depend on files in the prefix.
+                    exceptions.extend(self._run_post_scripts(group, base_env))
 
                     # parallel block 2:
                     futures = []
                     if install_side:
                         futures.extend(
-                            self.executor.submit(UnlinkLinkTransaction._execute_actions, axngroup)
+                            executor.submit(UnlinkLinkTransaction._execute_actions, axngroup)
                             for axngroup in entry_point_actions)
 
                         # consolidate compile actions into one big'un for better efficiency
@@ -623,9 +748,9 @@ class UnlinkLinkTransaction(object):
                             composite = AggregateCompileMultiPycAction(*individual_actions)
                             ag = ActionGroup('compile', None, [composite], composite.target_prefix)
                             futures.append(
-                                self.executor.submit(UnlinkLinkTransaction._execute_actions, ag))
+                                executor.submit(UnlinkLinkTransaction._execute_actions, ag))
                         futures.extend(
-                            self.executor.submit(UnlinkLinkTransaction._execute_actions, axngroup)
+                            executor.submit(UnlinkLinkTransaction._execute_actions, axngroup)
                             for axngroup in record_actions)
                     for future in as_completed(futures):
                         exc = future.result()
@@ -633,9 +758,7 @@ class UnlinkLinkTransaction(object):
                             exceptions.append(exc)
 
                     # must do the register actions AFTER all link/unlink is done
-                    register_actions = tuple(group for group in all_action_groups
-                                             if group.type == register_group)
-                    for axngroup in register_actions:
+                    for axngroup in groups_by_type[register_group]:
                         exc = UnlinkLinkTransaction._execute_actions(axngroup)
                         if exc:
                             exceptions.append(exc)
@@ -659,12 +782,12 @@ class UnlinkLinkTransaction(object):
                 if context.rollback_enabled:
                     with Spinner("Rolling back transaction",
                                  not context.verbosity and not context.quiet, context.json):
-                        reverse_actions = reversed(tuple(all_action_groups))
+                        reverse_actions = reversed(all_action_groups)
                         for axngroup in reverse_actions:
                             excs = UnlinkLinkTransaction._reverse_actions(axngroup)
                             rollback_excs.extend(excs)
 
-                raise CondaMultiError(tuple(concatv(
+                raise CondaMultiError(tuple(chain(
                     ((e.errors[0], e.errors[2:])
                      if isinstance(e, CondaMultiError)
                      else (e,)),
@@ -672,22 +795,65 @@ class UnlinkLinkTransaction(object):
                 )))
             else:
 
-                link_actions = tuple(
-                    group for group in all_action_groups if group.type in ("link", "register"))
                 for axngroup in all_action_groups:
                     for action in axngroup.actions:
                         action.cleanup()
 
+    @staticmethod
+    def _create_link_directories(link_action_groups):
+        # packages share many of their leaf directories (bin, lib, site-packages, ...); create
+        #   each one once, parents first, rather than once per package from the worker threads
+        directory_actions = defaultdict(list)
+        for axngroup in link_action_groups:
+            for axn in axngroup.actions:
+                if getattr(axn, 'link_type', None) == LinkType.directory:
+                    directory_actions[axn.target_full_path].append(axn)
+        for target_full_path in sorted(directory_actions):
+            axns = directory_actions[target_full_path]
+            try:
+                axns[0].execute()
+            except Exception as e:
+                # leave the actions pending; the failure resurfaces when their package group
+                #   executes, where it's handled and rolled back
+                log.debug("unable to create directory %s\n%r", target_full_path, e)
+                continue
+            for axn in axns[1:]:
+                axn.mark_executed()
+
+    def _run_pre_scripts(self, axngroups, install_side, base_env=None):
+        # pre-link scripts run from each package's own extracted directory, so they can run
+        #   concurrently unless the user asked to keep them serial; pre-unlink scripts all run
+        #   in the target prefix and share its .messages.txt, so they always run serially
+        if install_side and context.parallel_pre_link_scripts:
+            futures = tuple(self.execute_executor.submit(UnlinkLinkTransaction._run_pre_script,
+                                                         axngroup, base_env)
+                            for axngroup in axngroups)
+            # let every script finish before a failure propagates and rollback begins
+            for future in futures:
+                future.exception()
+            for future in futures:
+                future.result()
+        else:
+            for axngroup in axngroups:
+                UnlinkLinkTransaction._run_pre_script(axngroup, base_env)
+
+    @staticmethod
+    def _run_pre_script(axngroup, base_env=None):
+        is_unlink = axngroup.type == 'unlink'
+        target_prefix = axngroup.target_prefix
+        prec = axngroup.pkg_data
+        run_script(target_prefix if is_unlink else prec.extracted_package_dir,
+                   prec,
+                   'pre-unlink' if is_unlink else 'pre-link',
+                   target_prefix,
+                   base_env=base_env)
+
     @staticmethod
     def _execute_actions(axngroup):
         target_prefix = axngroup.target_prefix
         action = None
         prec = axngroup.pkg_data
 
-        conda_meta_dir = join(target_prefix, 'conda-meta')
-        if not isdir(conda_meta_dir):
-            mkdir_p(conda_meta_dir)
-
         try:
             if axngroup.type == 'unlink':
                 log.info("===> UNLINKING PACKAGE: %s <===\n"
@@ -707,27 +873,58 @@ class UnlinkLinkTransaction(object):
             reverse_excs = ()
             if context.rollback_enabled:
                 reverse_excs = UnlinkLinkTransaction._reverse_actions(axngroup)
-            return CondaMultiError(tuple(concatv(
+            return CondaMultiError(tuple(chain(
                 (e,),
                 (axngroup,),
                 reverse_excs,
             )))
 
+    def _run_post_scripts(self, axngroups, base_env=None):
+        # run the scripts serially within a prefix, just in case order matters (hopefully not);
+        #   separate prefixes share no files, so those run side by side
+        groups_by_prefix = odict()
+        for axngroup in axngroups:
+            groups_by_prefix.setdefault(axngroup.target_prefix, []).append(axngroup)
+        futures = tuple(
+            self.execute_executor.submit(UnlinkLinkTransaction._execute_prefix_post_link_actions,
+                                         prefix_groups, base_env)
+            for prefix_groups in groups_by_prefix.values())
+        # collect in prefix order, so the first error reported doesn't depend on timing
+        exceptions = []
+        for future in futures:
+            exceptions.extend(future.result())
+        return exceptions
+
+    @staticmethod
+    def _execute_prefix_post_link_actions(axngroups, base_env=None):
+        # most packages have no script, so list the prefix's script directory once rather than
+        #   probing for every package's script file
+        script_names = None
+        exceptions = []
+        for axngroup in axngroups:
+            if script_names is None:
+                script_names = list_script_names(axngroup.target_prefix)
+            exc = UnlinkLinkTransaction._execute_post_link_actions(axngroup, script_names,
+                                                                   base_env)
+            if exc:
+                exceptions.append(exc)
+        return exceptions
+
     @staticmethod
-    def _execute_post_link_actions(axngroup):
+    def _execute_post_link_actions(axngroup, script_names=None, base_env=None):
         target_prefix = axngroup.target_prefix
         is_unlink = axngroup.type == 'unlink'
         prec = axngroup.pkg_data
         if prec:
             try:
                 run_script(target_prefix, prec, 'post-unlink' if is_unlink else 'post-link',
-                           activate=True)
+                           activate=True, script_names=script_names, base_env=base_env)
             except Exception as e:  # this won't be a multi error
                 # reverse this package
                 reverse_excs = ()
                 if context.rollback_enabled:
                     reverse_excs = UnlinkLinkTransaction._reverse_actions(axngroup)
-                return CondaMultiError(tuple(concatv(
+                return CondaMultiError(tuple(chain(
                     (e,),
                     (axngroup,),
                     reverse_excs,
@@ -749,11 +946,10 @@ class UnlinkLinkTransaction(object):
                      "  prefix=%s\n", prec.dist_str(), target_prefix)
 
         exceptions = []
-        if reverse_from_idx < 0:
-            reverse_actions = axngroup.actions
-        else:
-            reverse_actions = axngroup.actions[:reverse_from_idx+1]
-        for axn_idx, action in reversed(tuple(enumerate(reverse_actions))):
+        actions = axngroup.actions
+        num_to_reverse = len(actions) if reverse_from_idx < 0 else reverse_from_idx + 1
+        for axn_idx in range(num_to_reverse - 1, -1, -1):
+            action = actions[axn_idx]
             try:
                 action.reverse()
             except Exception as e:
@@ -812,7 +1008,7 @@ class UnlinkLinkTransaction(object):
         # else:
         #     application_entry_point_actions = ()
         #     application_softlink_actions = ()
-        # leased_paths = tuple(axn.leased_path_entry for axn in concatv(
+        # leased_paths = tuple(axn.leased_path_entry for axn in chain(
         #     application_entry_point_actions,
         #     application_softlink_actions,
         # ))
@@ -825,7 +1021,7 @@ class UnlinkLinkTransaction(object):
         #     register_private_env_actions = ()
 
         # the ordering here is significant
-        return tuple(concatv(
+        return tuple(chain(
             create_directory_actions,
             file_link_actions,
             create_nonadmin_actions,
@@ -836,15 +1032,14 @@ class UnlinkLinkTransaction(object):
 
     @staticmethod
     def _make_entry_point_actions(transaction_context, package_info, target_prefix,
-                                  requested_link_type, requested_spec, link_action_groups):
+                                  requested_link_type, requested_spec, link_action_group):
         required_quad = transaction_context, package_info, target_prefix, requested_link_type
         return CreatePythonEntryPointAction.create_actions(*required_quad)
 
     @staticmethod
     def _make_compile_actions(transaction_context, package_info, target_prefix,
-                              requested_link_type, requested_spec, link_action_groups):
+                              requested_link_type, requested_spec, link_action_group):
         required_quad = transaction_context, package_info, target_prefix, requested_link_type
-        link_action_group = next(ag for ag in link_action_groups if ag.pkg_data == package_info)
         return CompileMultiPycAction.create_actions(*required_quad,
                                                     file_link_actions=link_action_group.actions)
 
@@ -856,19 +1051,19 @@ class UnlinkLinkTransaction(object):
         if self._pfe is None:
             self._get_pfe()
 
-        for q, (prefix, setup) in enumerate(iteritems(self.prefix_setups)):
+        for q, (prefix, setup) in enumerate(self.prefix_setups.items()):
             actions = defaultdict(list)
             if q == 0:
-                self._pfe.prepare()
-                download_urls = set(axn.url for axn in self._pfe.cache_actions)
+                download_urls = self._get_download_urls()
                 actions['FETCH'].extend(prec for prec in self._pfe.link_precs
                                         if prec.url in download_urls)
 
             actions['PREFIX'] = setup.target_prefix
-            for prec in setup.unlink_precs:
-                actions['UNLINK'].append(prec)
-            for prec in setup.link_precs:
-                actions['LINK'].append(prec)
+            # only add the keys when there are records; the json output omits empty ones
+            if setup.unlink_precs:
+                actions['UNLINK'] = list(setup.unlink_precs)
+            if setup.link_precs:
+                actions['LINK'] = list(setup.link_precs)
 
             legacy_action_groups.append(actions)
 
@@ -877,9 +1072,9 @@ class UnlinkLinkTransaction(object):
     def print_transaction_summary(self):
         legacy_action_groups = self._make_legacy_action_groups()
 
-        download_urls = set(axn.url for axn in self._pfe.cache_actions)
+        download_urls = self._get_download_urls()
 
-        for actions, (prefix, stp) in zip(legacy_action_groups, iteritems(self.prefix_setups)):
+        for actions, (prefix, stp) in zip(legacy_action_groups, self.prefix_setups.items()):
             change_report = self._calculate_change_report(prefix, stp.unlink_precs, stp.link_precs,
                                                           download_urls, stp.remove_specs,
                                                           stp.update_specs)
@@ -1030,24 +1225,25 @@ class UnlinkLinkTransaction(object):
                                  specs_to_add):
         unlink_map = {prec.namekey: prec for prec in unlink_precs}
         link_map = {prec.namekey: prec for prec in link_precs}
-        unlink_namekeys, link_namekeys = set(unlink_map), set(link_map)
 
-        removed_precs = {namekey: unlink_map[namekey]
-                         for namekey in (unlink_namekeys - link_namekeys)}
-        new_precs = {namekey: link_map[namekey]
-                     for namekey in (link_namekeys - unlink_namekeys)}
+        removed_precs = {namekey: unlink_prec for namekey, unlink_prec in unlink_map.items()
+                         if namekey not in link_map}
 
         # updated means a version increase, or a build number increase
         # downgraded means a version decrease, or build number decrease, but channel canonical_name
         #   has to be the same
         # superseded then should be everything else left over
+        new_precs = {}
         updated_precs = {}
         downgraded_precs = {}
         superseded_precs = {}
 
-        common_namekeys = link_namekeys & unlink_namekeys
-        for namekey in common_namekeys:
-            unlink_prec, link_prec = unlink_map[namekey], link_map[namekey]
+        for namekey, link_prec in link_map.items():
+            unlink_prec = unlink_map.get(namekey)
+            if unlink_prec is None:
+                new_precs[namekey] = link_prec
+                continue
+            # VersionOrder instances are cached per version string, so this doesn't reparse
             unlink_vo = VersionOrder(unlink_prec.version)
             link_vo = VersionOrder(link_prec.version)
             build_number_increases = link_prec.build_number > unlink_prec.build_number
@@ -1063,35 +1259,63 @@ class UnlinkLinkTransaction(object):
             else:
                 superseded_precs[namekey] = (unlink_prec, link_prec)
 
-        fetch_precs = set(prec for prec in link_precs if prec.url in download_urls)
+        # with a warm package cache there's usually nothing to download at all
+        fetch_precs = (set(prec for prec in link_precs if prec.url in download_urls)
+                       if download_urls else set())
         change_report = ChangeReport(prefix, specs_to_remove, specs_to_add, removed_precs,
                                      new_precs, updated_precs, downgraded_precs, superseded_precs,
                                      fetch_precs)
         return change_report
 
 
-def run_script(prefix, prec, action='post-link', env_prefix=None, activate=False):
+# where package scripts live in a prefix, their extension, and the shell that runs them
+_SCRIPT_DIR = 'Scripts' if on_win else 'bin'
+_SCRIPT_EXT = 'bat' if on_win else 'sh'
+_SCRIPT_SHELL = 'sh' if 'bsd' in sys.platform else 'bash'
+
+# the pre-link script lines that mark an old-style noarch package; only the first applies on
+#   windows
+_OLD_NOARCH_RE = re.compile(b"|".join(re.escape(marker) for marker in (
+    ((b"%PREFIX%\\python.exe %SOURCE_DIR%\\link.py",) if on_win else ())
+    + (b"$PREFIX/bin/python $SOURCE_DIR/link.py",)
+)))
+
+
+def list_script_names(prefix):
+    """
+    return the names in the prefix's script directory, for passing to run_script
+    """
+    try:
+        return frozenset(map(_lower_on_win, listdir(join(prefix, _SCRIPT_DIR))))
+    except EnvironmentError:
+        return frozenset()
+
+
+def run_script(prefix, prec, action='post-link', env_prefix=None, activate=False,
+               script_names=None, base_env=None):
     """
     call the post-link (or pre-unlink) script, and return True on success,
     False on failure
+
+    script_names, from list_script_names, lets a missing script be skipped without a stat;
+    base_env, a snapshot of os.environ, is copied in place of os.environ itself
     """
-    path = join(prefix,
-                'Scripts' if on_win else 'bin',
-                '.%s-%s.%s' % (prec.name, action, 'bat' if on_win else 'sh'))
+    script_name = '.%s-%s.%s' % (prec.name, action, _SCRIPT_EXT)
+    if script_names is not None and _lower_on_win(script_name) not in script_names:
+        return True
+    path = join(prefix, _SCRIPT_DIR, script_name)
     if not isfile(path):
         return True
 
-    env = os.environ.copy()
+    env = os.environ.copy() if base_env is None else base_env.copy()
 
     if action == 'pre-link':  # pragma: no cover
         # old no-arch support; deprecated
         is_old_noarch = False
         try:
-            with open(path) as f:
-                script_text = ensure_text_type(f.read())
-            if ((on_win and "%PREFIX%\\python.exe %SOURCE_DIR%\\link.py" in script_text)
-                    or "$PREFIX/bin/python $SOURCE_DIR/link.py" in script_text):
-                is_old_noarch = True
+            # the markers are plain ascii, so search the raw bytes rather than decoding
+            with open(path, 'rb') as f:
+                is_old_noarch = _OLD_NOARCH_RE.search(f.read()) is not None
         except Exception as e:
             log.debug(e, exc_info=True)
 
@@ -1112,6 +1336,8 @@ def run_script(prefix, prec, action='post-link', env_prefix=None, activate=False
         except KeyError:
             log.info("failed to run %s for %s due to COMSPEC KeyError", action, prec.dist_str())
             return False
+        # env may come from a snapshot taken before ensure_comspec_set() corrected os.environ
+        env[str('COMSPEC')] = comspec
         if activate:
             script_caller, command_args = wrap_subprocess_call(
                 on_win, context.root_prefix, prefix, context.dev, False, ('@CALL', path)
@@ -1119,14 +1345,12 @@ def run_script(prefix, prec, action='post-link', env_prefix=None, activate=False
         else:
             command_args = [comspec, '/d', '/c', path]
     else:
-        shell_path = 'sh' if 'bsd' in sys.platform else 'bash'
         if activate:
             script_caller, command_args = wrap_subprocess_call(
                 on_win, context.root_prefix, prefix, context.dev, False, (".", path)
             )
         else:
-            shell_path = 'sh' if 'bsd' in sys.platform else 'bash'
-            command_args = [shell_path, "-x", path]
+            command_args = [_SCRIPT_SHELL, "-x", path]
 
     env['ROOT_PREFIX'] = context.root_prefix
     env['PREFIX'] = env_prefix or prefix
@@ -1178,12 +1402,20 @@ def run_script(prefix, prec, action='post-link', env_prefix=None, activate=False
 def messages(prefix):
     path = join(prefix, '.messages.txt')
     try:
-        if isfile(path):
-            with open(path) as fi:
-                m = fi.read()
-                if hasattr(m, "decode"):
-                    m = m.decode('utf-8')
-                print(m.encode('utf-8'), file=sys.stderr if context.json else sys.stdout)
-                return m
+        fi = open(path, 'rb')
+    except EnvironmentError as e:
+        if e.errno != ENOENT:
+            # not a readable file (e.g. a directory); there's nothing to show, just clear it
+            rm_rf(path)
+        return
+    try:
+        with fi:
+            m = fi.read().decode('utf-8', 'replace')
     finally:
-        rm_rf(path)
+        try:
+            os.unlink(path)
+        except EnvironmentError as e:
+            log.trace("could not remove %s: %r", path, e)
+    # python 2 can't print non-ascii text to a pipe, while python 3 would show bytes as b'...'
+    print(m if PY3 else m.encode('utf-8'), file=sys.stderr if context.json else sys.stdout)
+    return m
@@ -32,7 +32,7 @@ from ..gateways.disk.create import (compile_multiple_pyc, copy,
                                     create_hard_link_or_copy, create_link,
                                     create_python_entry_point, extract_tarball,
                                     make_menu, mkdir_p, write_as_json_to_file)
-from ..gateways.disk.delete import rm_rf
+from ..gateways.disk.delete import rm_rf, rmdir_if_empty
 from ..gateways.disk.permissions import make_writable
 from ..gateways.disk.read import (compute_md5sum, compute_sha256sum, islink, lexists,
                                   read_index_json)
@@ -371,11 +371,17 @@ class LinkPathAction(CreateInPrefixPathAction):
         self._verified = True
 
     def execute(self):
+        if self._execute_successful:
+            # e.g. a directory shared with another package, created ahead of time
+            return
         log.trace("linking %s => %s", self.source_full_path, self.target_full_path)
         create_link(self.source_full_path, self.target_full_path, self.link_type,
                     force=context.force)
         self._execute_successful = True
 
+    def mark_executed(self):
+        self._execute_successful = True
+
     def reverse(self):
         if self._execute_successful:
             log.trace("reversing link creation %s", self.target_prefix)
@@ -1015,7 +1021,11 @@ class UnlinkPathAction(RemoveFromPrefixPathAction):
             backoff_rename(self.holding_full_path, self.target_full_path, force=True)
 
     def cleanup(self):
-        if not isdir(self.holding_full_path):
+        if self.link_type == LinkType.directory:
+            # directory actions are ordered deepest-first, after the files they contain, so
+            #   a directory left empty by the transaction only needs a single rmdir
+            rmdir_if_empty(self.target_full_path)
+        elif not isdir(self.holding_full_path):
             rm_rf(self.holding_full_path, clean_empty_parents=True)
 
 
@@ -343,6 +343,17 @@ def create_link(src, dst, link_type=LinkType.hardlink, force=False):
         mkdir_p(dst)
         return
 
+    if link_type == LinkType.hardlink:
+        # The common case is a plain file linking into a path that doesn't exist yet. Try that
+        #   directly, so each file costs a single link() call; the lexists()/isdir() checks
+        #   below only run when it fails.
+        try:
+            link(src, dst)
+            return
+        except (IOError, OSError) as e:
+            log.trace("direct hard link failed, falling back to checked link\n"
+                      "  error: %r", e)
+
     if not lexists(src):
         raise CondaError("Cannot link a source that does not exist. %s\n"
                          "Running `conda clean --packages` may resolve your problem." % src)
@@ -148,6 +148,16 @@ def remove_empty_parent_paths(path):
         parent_path = dirname(parent_path)
 
 
+def rmdir_if_empty(path):
+    """Remove path with a single rmdir() call, returning False if it isn't an empty directory."""
+    try:
+        rmdir(path)
+        return True
+    except EnvironmentError as e:
+        log.trace("rmdir_if_empty left %s in place (errno %s)", path, e.errno)
+        return False
+
+
 def rm_rf(path, max_retries=5, trash=True, clean_empty_parents=False, *args, **kw):
     """
     Completely delete path
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012 Anaconda, Inc
+# SPDX-License-Identifier: BSD-3-Clause
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from os.path import isdir, join
+from time import sleep
+
+from conda import CondaError
+from conda._vendor.auxlib.collection import AttrDict
+from conda.base.context import conda_tests_ctxt_mgmt_def_pol
+from conda.common.compat import PY3, on_win, text_type
+from conda.common.io import env_var
+from conda.core import link
+from conda.core.link import (ActionGroup, PrefixActionGroup, UnlinkLinkTransaction,
+                             determine_link_type, list_script_names, make_unlink_actions,
+                             match_specs_to_dists, messages, run_script)
+from conda.core.path_actions import CreatePrefixRecordAction, LinkPathAction, UnlinkPathAction
+from conda.exceptions import KnownPackageClobberError, UnknownPackageClobberError
+from conda.models.enums import LinkType
+from conda.models.records import PackageRecord
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+
+def _pkg_info(name):
+    return AttrDict(repodata_record=AttrDict(name=name))
+
+
+def test_match_specs_to_dists():
+    packages_info_to_link = tuple(_pkg_info(name) for name in ('numpy', 'python', 'six'))
+    matched = match_specs_to_dists(packages_info_to_link, ('six >=1.10', 'python=3.7', 'flask'))
+    assert len(matched) == 3
+    assert matched[0] is None
+    assert matched[1].name == 'python'
+    assert matched[2].name == 'six'
+    assert str(matched[2]) == 'six[version=\'>=1.10\']'
+
+
+def test_match_specs_to_dists_no_specs():
+    packages_info_to_link = (_pkg_info('python'),)
+    assert match_specs_to_dists(packages_info_to_link, None) == (None,)
+    assert match_specs_to_dists((), ('python',)) == ()
+
+
+def _unlink_directories(actions):
+    return [axn.target_short_path for axn in actions
+            if isinstance(axn, UnlinkPathAction) and axn.link_type == LinkType.directory]
+
+
+def test_make_unlink_actions_directories():
+    prefix_rec = AttrDict(name='foo', version='1.0', build='0',
+                          extracted_package_dir='/pkgs/foo-1.0-0',
+                          files=['bin/foo', 'share/foo/a/b.txt', 'share/foo/c.txt'])
+    actions = make_unlink_actions({}, '/prefix', prefix_rec)
+    assert _unlink_directories(actions) == ['share/foo/a', 'share/foo', 'share', 'bin']
+
+    actions = make_unlink_actions({}, '/prefix', prefix_rec, ())
+    assert _unlink_directories(actions) == []
+    assert actions[-1].target_short_path == 'conda-meta/foo-1.0-0.json'
+
+
+def test_determine_link_type_probes_once_per_package_cache():
+    probed = []
+
+    def hardlink_supported(source_file, dest_dir):
+        probed.append((source_file, dest_dir))
+        return True
+
+    with patch.object(link, 'hardlink_supported', hardlink_supported), \
+            patch.object(link, '_LINK_SUPPORT_CACHE', {}):
+        for pkg in ('a-1.0-0', 'b-1.0-0', 'c-1.0-0'):
+            assert determine_link_type('/pkgs/' + pkg, '/prefix') == LinkType.hardlink
+        assert determine_link_type('/other-pkgs/a-1.0-0', '/prefix') == LinkType.hardlink
+    assert [dest_dir for _, dest_dir in probed] == ['/prefix', '/prefix']
+    assert probed[1][0].startswith('/other-pkgs/a-1.0-0')
+
+
+def test_create_link_directories_once_per_path(tmpdir):
+    target_prefix = str(tmpdir)
+    axns = [LinkPathAction({}, None, None, None, target_prefix, short_path, LinkType.directory,
+                           None)
+            for short_path in ('bin', 'lib/python3.7/site-packages/foo', 'bin')]
+    groups = [ActionGroup('link', None, [axn], target_prefix) for axn in axns]
+    with patch.object(LinkPathAction, 'execute', autospec=True,
+                      side_effect=LinkPathAction.execute) as execute:
+        UnlinkLinkTransaction._create_link_directories(groups)
+        assert execute.call_count == 2
+        assert isdir(join(target_prefix, 'bin'))
+        assert isdir(join(target_prefix, 'lib', 'python3.7', 'site-packages', 'foo'))
+    assert all(axn._execute_successful for axn in axns)
+
+
+def _prec(name, version, build_number=0, channel='defaults'):
+    return PackageRecord(name=name, version=version, build='%s_%d' % (name, build_number),
+                         build_number=build_number, channel=channel, subdir='linux-64',
+                         fn='%s-%s.tar.bz2' % (name, version))
+
+
+def test_calculate_change_report():
+    unlink_precs = (_prec('a', '1.0'), _prec('b', '1.0'), _prec('c', '2.0'),
+                    _prec('d', '1.0'), _prec('e', '1.0'))
+    link_precs = (_prec('b', '1.0', build_number=1), _prec('c', '1.0'),
+                  _prec('d', '1.0', channel='conda-forge'), _prec('e', '1.0'), _prec('f', '1.0'))
+    change_report = UnlinkLinkTransaction._calculate_change_report(
+        '/prefix', unlink_precs, link_precs, (), (), ())
+    assert set(change_report.removed_precs) == {'global:a'}
+    assert set(change_report.new_precs) == {'global:f'}
+    assert set(change_report.updated_precs) == {'global:b'}
+    assert set(change_report.downgraded_precs) == {'global:c'}
+    assert set(change_report.superseded_precs) == {'global:d'}
+
+
+def test_run_script_skips_unlisted_scripts(tmpdir):
+    target_prefix = str(tmpdir)
+    assert list_script_names(target_prefix) == frozenset()
+    script_dir = tmpdir.mkdir('Scripts' if on_win else 'bin')
+    script_dir.join('.foo-post-link.%s' % ('bat' if on_win else 'sh')).write('exit 1\n')
+    script_names = list_script_names(target_prefix)
+    assert len(script_names) == 1
+
+    prec = _prec('bar', '1.0')
+    with patch.object(link, 'isfile') as isfile:
+        assert run_script(target_prefix, prec, script_names=script_names) is True
+    assert not isfile.called
+
+
+def test_messages(tmpdir, capsys):
+    target_prefix = str(tmpdir)
+    assert messages(target_prefix) is None
+    tmpdir.join('.messages.txt').write_binary('caf\xe9 ok\n'.encode('utf-8'))
+    assert messages(target_prefix) == 'caf\xe9 ok\n'
+    assert not tmpdir.join('.messages.txt').exists()
+    if PY3:
+        assert capsys.readouterr().out == 'caf\xe9 ok\n\n'
+
+
+class _FakeVerifyAction(object):
+
+    def __init__(self, error=None):
+        self.verified = False
+        self.error = error
+
+    def verify(self):
+        return self.error
+
+
+def _prefix_action_group(target_prefix, actions):
+    link_group = ActionGroup('link', None, actions, target_prefix)
+    return PrefixActionGroup((), (), [link_group], (), (), (), ())
+
+
+def test_verify_individual_level_in_slices():
+    errors = [CondaError('bad %d' % q) for q in range(3)]
+    actions = [_FakeVerifyAction() for _ in range(10)]
+    actions[0].error, actions[4].error, actions[9].error = errors
+    actions[5].verified = True
+    actions[5].error = CondaError('already verified')
+    submitted = []
+    _verify_actions = link._verify_actions
+
+    def verify_actions(action_slice):
+        submitted.append(len(action_slice))
+        return _verify_actions(action_slice)
+
+    txn = UnlinkLinkTransaction()
+    with patch.object(link, '_VERIFY_SLICE_SIZE', 4), \
+            patch.object(link, '_verify_actions', verify_actions):
+        error_results = txn._verify_individual_level(
+            (_prefix_action_group('/a', actions[:6]), _prefix_action_group('/b', actions[6:])))
+    assert error_results == errors
+    # both prefixes' actions are pooled into slices, without the verified one
+    assert sorted(submitted) == [1, 4, 4]
+
+
+def test_verify_individual_level_single_slice_skips_executor():
+    actions = [_FakeVerifyAction() for _ in range(3)]
+    actions[1].error = error = CondaError('bad')
+    txn = UnlinkLinkTransaction()
+    with patch.object(txn, 'executor') as executor:
+        error_results = txn._verify_individual_level(
+            (_prefix_action_group('/a', actions[:2]), _prefix_action_group('/b', actions[2:])))
+    assert error_results == [error]
+    assert not executor.map.called
+
+
+def test_run_script_windows_comspec_overrides_base_env(tmpdir):
+    target_prefix = str(tmpdir)
+    tmpdir.mkdir(link._SCRIPT_DIR).join('.bar-post-link.%s' % link._SCRIPT_EXT).write('')
+    environ = {str('COMSPEC'): str('C:\\Windows\\System32\\cmd.exe')}
+    base_env = {str('COMSPEC'): str('stale'), str('PATH'): str('')}
+    calls = []
+
+    def subprocess_call(command_args, env, path, raise_on_error):
+        calls.append((command_args, env))
+        return AttrDict(rc=0, stdout='', stderr='')
+
+    with patch.object(link, 'on_win', True), \
+            patch.object(link, 'ensure_comspec_set'), \
+            patch.object(link.os, 'environ', environ), \
+            patch.object(link, 'subprocess_call', subprocess_call):
+        assert run_script(target_prefix, _prec('bar', '1.0'), base_env=base_env) is True
+    (command_args, env), = calls
+    assert command_args[0] == env['COMSPEC'] == environ['COMSPEC']
+    assert base_env['COMSPEC'] == 'stale'
+
+
+def _pre_script_groups(group_type):
+    return [ActionGroup(group_type, AttrDict(name=name), [], '/prefix')
+            for name in ('a', 'b', 'c')]
+
+
+def _run_pre_scripts(parallel, install_side, fail_name=None):
+    ran = []
+
+    def run_pre_script(axngroup, base_env=None):
+        if fail_name and axngroup.pkg_data.name != fail_name:
+            sleep(0.2)
+        ran.append(axngroup.pkg_data.name)
+        if axngroup.pkg_data.name == fail_name:
+            raise CondaError('%s failed' % fail_name)
+
+    txn = UnlinkLinkTransaction()
+    groups = _pre_script_groups('link' if install_side else 'unlink')
+    executor = txn.execute_executor
+    with env_var('CONDA_PARALLEL_PRE_LINK_SCRIPTS', 'true' if parallel else 'false',
+                 stack_callback=conda_tests_ctxt_mgmt_def_pol), \
+            patch.object(UnlinkLinkTransaction, '_run_pre_script',
+                         staticmethod(run_pre_script)), \
+            patch.object(executor, 'submit', wraps=executor.submit) as submit:
+        try:
+            txn._run_pre_scripts(groups, install_side)
+        except CondaError as e:
+            assert text_type(e) == '%s failed' % fail_name
+        else:
+            assert fail_name is None
+    return ran, submit.call_count
+
+
+def test_run_pre_scripts_parallel_pre_link():
+    ran, submitted = _run_pre_scripts(parallel=True, install_side=True)
+    assert sorted(ran) == ['a', 'b', 'c']
+    assert submitted == 3
+
+    # a failing script doesn't stop the rest from finishing before the error propagates
+    ran, submitted = _run_pre_scripts(parallel=True, install_side=True, fail_name='a')
+    assert sorted(ran) == ['a', 'b', 'c']
+
+
+def test_run_pre_scripts_serial():
+    # pre-unlink scripts share the prefix's .messages.txt, so they're always serial
+    assert _run_pre_scripts(parallel=True, install_side=False) == (['a', 'b', 'c'], 0)
+    assert _run_pre_scripts(parallel=False, install_side=True) == (['a', 'b', 'c'], 0)
+    assert _run_pre_scripts(parallel=False, install_side=False) == (['a', 'b', 'c'], 0)
+
+
+def _link_path_axn(short_path, link_type=LinkType.hardlink):
+    return Mock(spec=LinkPathAction, target_short_path=short_path, link_type=link_type)
+
+
+def _pkg_info_with_dist_str(dist_str):
+    return AttrDict(repodata_record=AttrDict(dist_str=lambda: dist_str))
+
+
+def _verify_prefix_level(target_prefix, link_path_actions, unlink_short_paths=(),
+                         prefix_recs=()):
+    unlink_group = ActionGroup('unlink', None, [Mock(spec=UnlinkPathAction, target_short_path=p)
+                                                for p in unlink_short_paths], target_prefix)
+    record_axn = Mock(spec=CreatePrefixRecordAction, all_link_path_actions=link_path_actions,
+                      package_info=_pkg_info_with_dist_str('defaults::new-1.0-0'))
+    record_group = ActionGroup('record', None, [record_axn], target_prefix)
+    prefix_action_group = PrefixActionGroup([unlink_group], (), (), (), (), (), [record_group])
+    txn = UnlinkLinkTransaction()
+    txn._prefix_records_cache[target_prefix] = tuple(prefix_recs)
+    return [(type(e), e._kwargs['target_path'])
+            for e in txn._verify_prefix_level(target_prefix, prefix_action_group)]
+
+
+def _make_prefix(tmpdir, *short_paths):
+    for short_path in short_paths:
+        tmpdir.join(short_path).ensure()
+    return str(tmpdir)
+
+
+def test_verify_prefix_level_clobbers(tmpdir):
+    target_prefix = _make_prefix(tmpdir, 'bin/known', 'bin/stray', 'bin/old', 'lib/x.so')
+    known_rec = AttrDict(files=['bin/known'], dist_str=lambda: 'defaults::known-1.0-0')
+    link_path_actions = [_link_path_axn(p) for p in ('bin/known', 'bin/stray', 'bin/old',
+                                                     'bin/fresh', 'share/fresh')]
+    link_path_actions.append(_link_path_axn('lib', LinkType.directory))
+    errors = _verify_prefix_level(target_prefix, link_path_actions,
+                                  unlink_short_paths=('bin/old',), prefix_recs=(known_rec,))
+    assert errors == [
+        (KnownPackageClobberError, 'bin/known'),
+        (UnknownPackageClobberError, 'bin/stray'),
+    ]
+
+
+def test_verify_prefix_level_case_insensitive_filesystem(tmpdir):
+    target_prefix = _make_prefix(tmpdir, 'bin/Foo', 'bin/bar')
+    foo_path = join(target_prefix, 'bin', 'foo')
+
+    def lexists(path):
+        return path.lower() == foo_path.lower()
+
+    link_path_actions = [_link_path_axn('bin/foo'), _link_path_axn('bin/bar')]
+    with patch.object(link, '_has_case_sensitive_names', return_value=False), \
+            patch.object(link, 'lexists', side_effect=lexists) as patched_lexists:
+        errors = _verify_prefix_level(target_prefix, link_path_actions)
+    assert errors == [(UnknownPackageClobberError, 'bin/foo'),
+                      (UnknownPackageClobberError, 'bin/bar')]
+    # exact matches don't need confirming
+    assert [c[0][0] for c in patched_lexists.call_args_list] == [foo_path]
+
+    with patch.object(link, '_has_case_sensitive_names', return_value=True), \
+            patch.object(link, 'lexists') as patched_lexists:
+        errors = _verify_prefix_level(target_prefix, link_path_actions)
+    assert errors == [(UnknownPackageClobberError, 'bin/bar')]
+    assert not patched_lexists.called
+
+
+def test_run_post_scripts_two_prefixes():
+    ran = []
+    failing = {'c', 'y'}
+
+    def execute_post_link_actions(axngroup, script_names=None, base_env=None):
+        name = axngroup.pkg_data.name
+        if axngroup.target_prefix == '/p1':
+            # make the first prefix finish last
+            sleep(0.05)
+        ran.append((axngroup.target_prefix, name))
+        if name in failing:
+            return CondaError('%s failed' % name)
+
+    axngroups = [ActionGroup('link', AttrDict(name=name), [], prefix)
+                 for prefix, name in (('/p1', 'a'), ('/p2', 'x'), ('/p1', 'b'),
+                                      ('/p2', 'y'), ('/p1', 'c'))]
+    txn = UnlinkLinkTransaction()
+    with patch.object(UnlinkLinkTransaction, '_execute_post_link_actions',
+                      staticmethod(execute_post_link_actions)):
+        exceptions = txn._run_post_scripts(axngroups)
+
+    assert [name for prefix, name in ran if prefix == '/p1'] == ['a', 'b', 'c']
+    assert [name for prefix, name in ran if prefix == '/p2'] == ['x', 'y']
+    assert [text_type(e) for e in exceptions] == ['c failed', 'y failed']
@@ -9,7 +9,7 @@ import pytest
 
 from conda.common.compat import on_win
 from conda.gateways.disk.create import create_link, mkdir_p, TemporaryDirectory
-from conda.gateways.disk.delete import move_to_trash, rm_rf
+from conda.gateways.disk.delete import move_to_trash, rm_rf, rmdir_if_empty
 from conda.gateways.disk.link import islink, symlink
 from conda.gateways.disk.test import softlink_supported
 from conda.gateways.disk.update import touch
@@ -47,6 +47,20 @@ def test_remove_file_to_trash():
         assert not isfile(test_path)
 
 
+def test_rmdir_if_empty():
+    with tempdir() as td:
+        empty_dir = join(td, 'empty')
+        full_dir = join(td, 'full')
+        mkdir_p(empty_dir)
+        mkdir_p(full_dir)
+        touch(join(full_dir, 'test_path'))
+        assert rmdir_if_empty(empty_dir)
+        assert not lexists(empty_dir)
+        assert not rmdir_if_empty(full_dir)
+        assert isfile(join(full_dir, 'test_path'))
+        assert not rmdir_if_empty(join(td, 'missing'))
+
+
 def test_remove_dir():
     with tempdir() as td:
         test_path = join(td, 'test_path')